@@ -0,0 +1,26 @@
+""".. Line to protect from pydocstyle D205, D400.
+
+GTF
+---
+
+Parse attributes column of GTF files.
+
+"""
+import re
+import sys
+
+# Key-value pairs in 9th column (attributes) of GTF file, e.g. ``gene_id "G1";``:
+ATTR_RE = re.compile(r'([^\s;]+)\s+"?([^";]*)"?')
+
+# Attributes with values that repeat across many lines, so it pays off to intern them:
+INTERN_VALUE_KEYS = frozenset([
+    'biotype', 'gene_biotype', 'gene_id', 'gene_name', 'gene_type', 'transcript_biotype', 'transcript_type',
+])
+
+
+def parse_attrs(col8):
+    """Parse attributes column of GTF file into dict, interning keys and frequently repeated values."""
+    return {
+        sys.intern(key): sys.intern(value) if key in INTERN_VALUE_KEYS else value
+        for key, value in ATTR_RE.findall(col8)
+    }
@@ -6,15 +6,23 @@ Regions
 Make regions file and summary templates.
 
 """
+import functools
+import gzip
+import heapq
 import itertools
 import logging
 import math
 import os
-import re
+import sys
+from collections import Counter, namedtuple
 
+import numpy
 from pybedtools import BedTool, create_interval_from_list
 
+import iCount
+
 from .constants import TYPE_HIERARCHY, SUBTYPE_GROUPS
+from .gtf import parse_attrs
 
 LOGGER = logging.getLogger(__name__)
 
@@ -26,6 +34,94 @@ SUMMARY_TYPE = 'summary_type.tsv'
 SUMMARY_SUBTYPE = 'summary_subtype.tsv'
 SUMMARY_GENE = 'summary_gene.tsv'
 
+# Buffer size (in bytes) used when writing output files:
+_WRITE_BUFFER_SIZE = 1 << 20
+
+# Rank of each type in TYPE_HIERARCHY (lower is more important):
+_TYPE_PRIORITY = {type_: rank for rank, type_ in enumerate(TYPE_HIERARCHY)}
+
+# Reverse mapping of SUBTYPE_GROUPS: biotype -> group.
+_BIOTYPE_GROUPS = {biotype: group for group, biotypes in SUBTYPE_GROUPS.items() for biotype in biotypes}
+# Each biotype has to belong to exactly one group for the mapping to be well defined:
+assert len(_BIOTYPE_GROUPS) == sum(len(biotypes) for biotypes in SUBTYPE_GROUPS.values())
+
+
+# Box between two consecutive borders, in BED coordinates:
+_Box = namedtuple('_Box', ['chrom', 'start', 'stop', 'strand'])
+
+
+def _read_fields(fname):
+    """
+    Read fields of each line in (optionally gzipped) GTF file.
+
+    Blank lines and header lines (comment, track, browser and SAM header
+    lines) are skipped, the same as when iterating over BedTool.
+    """
+    with iCount.files.gz_open(fname, 'rt') as handle:
+        for line in handle:
+            if not line.strip() or line.startswith(('@', '#', 'track', 'browser')):
+                continue
+            yield line.rstrip('\n').split('\t')
+
+
+def _parse_segmentation(rows):
+    """
+    Parse segmentation into gene sizes and segments grouped by chromosome and strand.
+
+    Segments exclude genes and transcripts. Each group of segments is
+    stored as a tuple of arrays: starts (in BED coordinates), stops and a
+    list of GTF fields of each segment.
+    """
+    gene_sizes = {'.': 0}  # Fill '.' as this is 'gene_id' for intergenic regions
+    segments = {}
+    for fields in rows:
+        if fields[2] == 'gene':
+            gene_id = parse_attrs(fields[8]).get('gene_id', None)
+            gene_sizes[gene_id] = int(fields[4]) - int(fields[3]) + 1
+            continue
+        if fields[2] == 'transcript':
+            continue
+        # Chromosome, source, type and strand values repeat in many lines:
+        for index in (0, 1, 2, 6):
+            fields[index] = sys.intern(fields[index])
+        starts, stops, data = segments.setdefault((fields[0], fields[6]), ([], [], []))
+        starts.append(int(fields[3]) - 1)
+        stops.append(int(fields[4]))
+        data.append(fields)
+
+    segments = {
+        key: (numpy.array(starts, dtype=numpy.int64), numpy.array(stops, dtype=numpy.int64), data)
+        for key, (starts, stops, data) in segments.items()
+    }
+    return gene_sizes, segments
+
+
+def _write_tsv(fname, rows):
+    """
+    Write rows of fields to tab-separated file.
+
+    Lines are written in large blocks to reduce the number of system calls.
+    Files ending with .gz are compressed.
+    """
+    lines = ('\t'.join(map(str, row)) + '\n' for row in rows)
+    if fname.endswith('.gz'):
+        with gzip.open(fname, 'wt') as handle:
+            handle.writelines(lines)
+    else:
+        with open(fname, 'wt', buffering=_WRITE_BUFFER_SIZE) as handle:
+            handle.writelines(lines)
+
+
+def _get_borders(starts, stops):
+    """Get sorted unique borders of segments."""
+    borders = numpy.concatenate([starts, stops])
+    borders.sort()
+    # Keep first border and each border that differs from the preceding one:
+    keep = numpy.empty(borders.size, dtype=bool)
+    keep[:1] = True
+    numpy.not_equal(borders[1:], borders[:-1], out=keep[1:])
+    return borders[keep]
+
 
 def construct_borders(seg_filtered):
     """
@@ -56,108 +152,109 @@ def construct_borders(seg_filtered):
         Absolute path to BED6 file with borders.
 
     """
-    borders_data = {}
-    for seg in BedTool(seg_filtered):
-        borders_data.setdefault((seg.chrom, seg.strand), set()).update([seg.start, seg.stop])
-
-    intervals = []
-    for (chrom, strand), borders in borders_data.items():
-        borders = list(sorted(borders))
-        for start, stop in zip(borders, borders[1:]):
-            intervals.append(create_interval_from_list([chrom, start, stop, '.', '.', strand]))
-
-    borders_bed = BedTool(interval for interval in intervals).sort().saveas()
-    return os.path.abspath(borders_bed.fn)
-
-
+    seg_filtered = BedTool(seg_filtered)
+    if isinstance(seg_filtered.fn, str):
+        # Reading the file directly is much faster than iterating over BedTool intervals:
+        rows = _read_fields(seg_filtered.fn)
+    else:
+        rows = (seg.fields for seg in seg_filtered)
+    groups = list(_parse_segmentation(rows)[1].items())
+    keys = [key for key, _ in groups]
+    chrom_rank = {chrom: rank for rank, chrom in enumerate(sorted({chrom for chrom, _ in keys}))}
+
+    # Columns of all boxes, group index is used to look up chromosome and strand of the box:
+    box_starts, box_stops, box_groups, box_chroms = [], [], [], []
+    for index, ((chrom, _), (starts, stops, _)) in enumerate(groups):
+        borders = _get_borders(starts, stops)
+        box_starts.append(borders[:-1])
+        box_stops.append(borders[1:])
+        box_groups.append(numpy.full(borders.size - 1, index, dtype=numpy.int64))
+        box_chroms.append(numpy.full(borders.size - 1, chrom_rank[chrom], dtype=numpy.int64))
+
+    borders_bed = iCount.files.get_temp_file_name(extension='bed')
+    if not groups:
+        _write_tsv(borders_bed, [])
+        return os.path.abspath(borders_bed)
+
+    box_starts, box_stops = numpy.concatenate(box_starts), numpy.concatenate(box_stops)
+    box_groups = numpy.concatenate(box_groups)
+    # Sort by chrom and start, same as ``bedtools sort`` does (lexsort is stable):
+    order = numpy.lexsort((box_starts, numpy.concatenate(box_chroms)))
+    _write_tsv(borders_bed, (
+        (keys[group][0], start, stop, '.', '.', keys[group][1])
+        for start, stop, group in zip(box_starts[order].tolist(), box_stops[order].tolist(),
+                                      box_groups[order].tolist())
+    ))
+    return os.path.abspath(borders_bed)
+
+
+@functools.lru_cache(maxsize=None)
 def simplify_biotype(type_, biotype):
     """Return generalized (broader category) biotype."""
+    group = _BIOTYPE_GROUPS.get(biotype)
+
     # First handle 'special' cases:
-    if biotype in SUBTYPE_GROUPS['mRNA'] and type_ == 'ncRNA':
+    if group == 'mRNA' and type_ == 'ncRNA':
         return 'lncRNA'
-    if biotype in SUBTYPE_GROUPS['mRNA'] and type_ == 'intron':
+    if group == 'mRNA' and type_ == 'intron':
         return 'pre-mRNA'
 
-    for group, biotypes in SUBTYPE_GROUPS.items():
-        if biotype in biotypes:
-            return group
-
-    return biotype
+    return group if group is not None else biotype
 
 
 def make_uniq_region(seg, types, biotypes, genes):
-    """Make pybedtools.Interval representing unique region."""
+    """
+    Make pybedtools.Interval representing unique region.
+
+    Only chrom, start, stop and strand of ``seg`` are used, so it can be
+    a pybedtools.Interval or any object with these attributes.
+    """
     assert len(types) == len(biotypes) == len(genes)
 
     # In case biotype is '3prime_overlapping_ncRNA', make sure type is UTR3
-    for i, biotype in enumerate(biotypes):
-        if biotype == '3prime_overlapping_ncRNA':
-            types[i] = 'UTR3'
+    types = ['UTR3' if biotype == '3prime_overlapping_ncRNA' else type_ for type_, biotype in zip(types, biotypes)]
 
-    idxs = None
     # Only consider segments with highest rated type:
-    for region_type in TYPE_HIERARCHY:
-        if region_type in types:
-            idxs = [i for i, typ in enumerate(types) if typ == region_type]
-            break
-    assert idxs
+    region_type = min(types, key=lambda type_: _TYPE_PRIORITY.get(type_, len(TYPE_HIERARCHY)))
+    assert region_type in _TYPE_PRIORITY
+    idxs = [i for i, type_ in enumerate(types) if type_ == region_type]
 
     # Simplify biotypes and pick unique ones
-    biotype_groups = set()
-    for i, item in enumerate(biotypes):
-        if i in idxs and item is not None:
-            # pylint: disable=undefined-loop-variable
-            biotype_groups.add(simplify_biotype(region_type, item))
-            # pylint: enable=undefined-loop-variable
-
-    # Note that each entry in `genes` is a tuple of form (gene_id, gene_name, gene_size)
-    genes = list(set([item for i, item in enumerate(genes) if i in idxs]))
-    if len(genes) > 1:
-        # In case there are two or more genes, pick the longest one:
-        gene_sizes = [gsize for (_, _, gsize) in genes]
-        max_index = gene_sizes.index(max(gene_sizes))
-        genes = [genes[max_index]]
-    assert len(genes) == 1
-
-    attrs = 'gene_id "{}"; gene_name "{}"; biotype "{}";'.format(
-        genes[0][0],
-        genes[0][1],
-        ','.join(sorted(biotype_groups)),
-    )
-    # pylint: disable=undefined-loop-variable
+    biotype_groups = {simplify_biotype(region_type, biotypes[i]) for i in idxs if biotypes[i] is not None}
+
+    # Note that each entry in `genes` is a tuple of form (gene_id, gene_name, gene_size). In
+    # case there are two or more genes, pick the longest one:
+    gene_id, gene_name, _ = max({genes[i] for i in idxs}, key=lambda gene: gene[2])
+
+    attrs = 'gene_id "{}"; gene_name "{}"; biotype "{}";'.format(gene_id, gene_name, ','.join(sorted(biotype_groups)))
     return create_interval_from_list(
         [seg.chrom, '.', region_type, seg.start + 1, seg.stop, '.', seg.strand, '.', attrs])
-    # pylint: enable=undefined-loop-variable
 
 
 def merge_regions(nonmerged, out_file):
     """Merge adjacent regions if they have same name (e.g. type, gene and biotypes)."""
     # Sort by chrom, strand, start
-    nonmerged_data = sorted([itr for itr in BedTool(nonmerged)], key=lambda x: (x.chrom, x.strand, x.start))
-    merged_data = []
+    nonmerged_data = sorted(BedTool(nonmerged), key=lambda x: (x.chrom, x.strand, x.start))
 
     def check_merge(itr):
         """Extract data needed to decide if intervals can be merged."""
         return (itr.chrom, itr.strand, itr[2], itr.attrs.get('biotype'), itr.attrs.get('gene_id'))
 
-    # But merge if the name is the same (type, biotypes and gene are all stored in name):
+    # Merge if the name is the same (type, biotypes and gene are all stored in name). Intervals
+    # within each group are already sorted by start, so take start of the first element in group
+    # and stop from the last one and copy other content:
+    merged_data = []
     for _, group in itertools.groupby(nonmerged_data, key=check_merge):
-        # Sort all intervals with same (chrom, strand and name) by start
-        ints = sorted(list(group), key=lambda x: x.start)
-        # Create "merged" interval: take start of first element in `ints` and stop from the last
-        # element, copy other content:
-        merged_data.append(create_interval_from_list(ints[0][:4] + [ints[-1][4]] + ints[0][5:]))
+        ints = list(group)
+        merged_data.append(ints[0][:4] + [ints[-1][4]] + ints[0][5:])
 
-    BedTool(itr for itr in merged_data).sort().saveas(out_file)
+    merged_data.sort(key=lambda x: (x[0], int(x[3])))
+    _write_tsv(out_file, merged_data)
 
 
 def get_gene_sizes(segmentation):
     """Calculate gene size for each gene in segmentation."""
-    gene_sizes = {'.': 0}  # Fill '.' as this is 'gene_id' for intergenic regions
-    for seg in BedTool(segmentation).filter(lambda x: x[2] == 'gene'):
-        gene_id = seg.attrs.get('gene_id', None)
-        gene_sizes[gene_id] = len(seg)
-    return gene_sizes
+    return _parse_segmentation(fields for fields in _read_fields(segmentation) if fields[2] == 'gene')[0]
 
 
 def make_subtype(type_, biotype):
@@ -188,38 +285,39 @@ def sort_types_subtypes(entry):
 
 def summary_templates(annotation, templates_dir):
     """Make summary templates."""
-    type_template, subtype_template, gene_template = {}, {}, {}
-    for interval in BedTool(annotation):
-        length = len(interval)
+    type_template, subtype_template, gene_template, gene_names = Counter(), Counter(), Counter(), {}
+    for fields in _read_fields(annotation):
+        length = int(fields[4]) - int(fields[3]) + 1
+        attrs = parse_attrs(fields[8])
 
-        type_ = interval[2]
-        type_template[type_] = type_template.get(type_, 0) + length
+        type_ = fields[2]
+        type_template[type_] += length
 
-        biotypes = interval.attrs.get('biotype', '').split(',')
+        biotypes = attrs.get('biotype', '').split(',')
         for biotype in biotypes:
-            sbtyp = make_subtype(type_, biotype)
-            subtype_template[sbtyp] = subtype_template.get(sbtyp, 0) + length / len(biotypes)
+            subtype_template[make_subtype(type_, biotype)] += length / len(biotypes)
 
-        gene_id = interval.attrs.get('gene_id', '')
-        gene_name = interval.attrs.get('gene_name', '')
-        current_size = gene_template.get(gene_id, ['', 0])[1]
-        gene_template[gene_id] = [gene_name, current_size + length]
+        gene_id = attrs.get('gene_id', '')
+        gene_names[gene_id] = attrs.get('gene_name', '')
+        gene_template[gene_id] += length
 
     # Write type template
-    with open(os.path.join(templates_dir, TEMPLATE_TYPE), 'wt') as outfile:
-        for type_, length in sorted(type_template.items(), key=lambda x: sort_types_subtypes(x[0])):
-            outfile.write('{}\t{}\n'.format(type_, math.floor(length)))
+    _write_tsv(os.path.join(templates_dir, TEMPLATE_TYPE), (
+        (type_, math.floor(length))
+        for type_, length in sorted(type_template.items(), key=lambda x: sort_types_subtypes(x[0]))
+    ))
 
     # Write subtype template
-    with open(os.path.join(templates_dir, TEMPLATE_SUBTYPE), 'wt') as outfile:
-        for subtype, length in sorted(subtype_template.items(), key=lambda x: sort_types_subtypes(x[0])):
-            outfile.write('{}\t{}\n'.format(subtype, math.floor(length)))
+    _write_tsv(os.path.join(templates_dir, TEMPLATE_SUBTYPE), (
+        (subtype, math.floor(length))
+        for subtype, length in sorted(subtype_template.items(), key=lambda x: sort_types_subtypes(x[0]))
+    ))
 
     # Write gene template
-    with open(os.path.join(templates_dir, TEMPLATE_GENE), 'wt') as outfile:
-        for gene_id, (gene_name, length) in sorted(gene_template.items()):
-            line = [gene_id, gene_name, str(math.floor(length))]
-            outfile.write('\t'.join(map(str, line)) + '\n')
+    _write_tsv(os.path.join(templates_dir, TEMPLATE_GENE), (
+        (gene_id, gene_names[gene_id], math.floor(length))
+        for gene_id, length in sorted(gene_template.items())
+    ))
 
 
 def make_regions(segmentation, out_dir=None):
@@ -229,42 +327,45 @@ def make_regions(segmentation, out_dir=None):
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir, exist_ok=True)
 
-    seg_filtered = BedTool(segmentation).filter(lambda x: x[2] not in ['transcript', 'gene']).saveas()
-
-    borders = construct_borders(seg_filtered)
-    # pylint: disable=unexpected-keyword-arg, too-many-function-args
-    overlaps = BedTool(borders).intersect(
-        seg_filtered, sorted=True, s=True, wa=True, wb=True, nonamecheck=True).saveas()
-    # pylint: enable=unexpected-keyword-arg, too-many-function-args
-
-    intervals, types, biotypes, genes = [], [], [], []
-    gene_sizes = get_gene_sizes(segmentation)
-    pseg = overlaps[0]  # Set initial value for "previous segment"
-    for seg in overlaps:
-        if seg.start != pseg.start or seg.stop != pseg.stop or seg.strand != pseg.strand:
-            intervals.append(make_uniq_region(pseg, types, biotypes, genes))
-            types, biotypes, genes = [], [], []
+    # Parse segmentation only once, gene sizes and segments are both needed:
+    gene_sizes, grouped_segments = _parse_segmentation(_read_fields(segmentation))
 
-        types.append(seg[8])  # In overlaps, this is 3rd column of GTF file
-
-        biotype = re.match(r'.*biotype "(.*?)";', seg[-1])
-        biotype = biotype.group(1) if biotype else None
-        biotypes.append(biotype)
-
-        gene_id = re.match(r'.*gene_id "(.*?)";', seg[-1])
-        gene_id = gene_id.group(1) if gene_id else None
-        gene_name = re.match(r'.*gene_name "(.*?)";', seg[-1])
-        gene_name = gene_name.group(1) if gene_name else None
-        genes.append((gene_id, gene_name, gene_sizes[gene_id]))
-
-        pseg = seg
+    intervals = []
+    for (chrom, strand), (starts, stops, segments) in grouped_segments.items():
+        # Data needed to make unique region from segments, determined once per segment:
+        seg_data = []
+        for fields in segments:
+            attrs = parse_attrs(fields[8])
+            gene_id = attrs.get('gene_id')
+            seg_data.append((
+                fields[2],
+                attrs.get('biotype'),
+                (gene_id, attrs.get('gene_name'), gene_sizes[gene_id]),
+            ))
+        order = numpy.argsort(starts, kind='stable').tolist()
+        seg_starts, seg_stops = starts.tolist(), stops.tolist()
+
+        # Sweep over boxes between consecutive borders. Heap holds (stop, index) of segments that
+        # start before the box. Once segments that stop before the box are popped, the remaining
+        # ones are exactly the segments that cover the whole box.
+        active = []
+        next_seg = 0
+        borders = _get_borders(starts, stops).tolist()
+        for start, stop in zip(borders, borders[1:]):
+            while next_seg < len(order) and seg_starts[order[next_seg]] <= start:
+                heapq.heappush(active, (seg_stops[order[next_seg]], order[next_seg]))
+                next_seg += 1
+            while active and active[0][0] <= start:
+                heapq.heappop(active)
+            if not active:
+                continue
 
-    intervals.append(make_uniq_region(pseg, types, biotypes, genes))
-    nonmerged = BedTool(interval for interval in intervals).saveas()
+            types, biotypes, genes = zip(*[seg_data[index] for _, index in active])
+            intervals.append(make_uniq_region(_Box(chrom, start, stop, strand), types, biotypes, genes))
 
     # Merge intervals where possible
     merged = os.path.join(out_dir, REGIONS_FILE)
-    merge_regions(nonmerged, merged)
+    merge_regions(intervals, merged)
 
     # Finally, make templates
     summary_templates(merged, out_dir)
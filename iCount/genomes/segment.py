@@ -87,19 +87,40 @@ Finally, this is how landamrks look like. Note that for example landmark
 
 """
 import logging
+import multiprocessing
 import os
 import shutil
 import tempfile
 from collections import Counter
 
+import numpy
 from pybedtools import BedTool, create_interval_from_list
 
 import iCount
+from .gtf import parse_attrs
 from .region import make_regions, REGIONS_FILE
 from .landmark import make_landmarks
 
 LOGGER = logging.getLogger(__name__)
 
+# Types of intervals that can follow given type of interval in transcript:
+_CAN_FOLLOW = {
+    '+': {
+        'UTR5': frozenset(['intron', 'CDS']),
+        'CDS': frozenset(['intron', 'UTR3']),
+        'intron': frozenset(['CDS', 'ncRNA', 'UTR3', 'UTR5']),
+        'UTR3': frozenset(['intron']),
+        'ncRNA': frozenset(['intron']),
+    },
+    '-': {
+        'UTR3': frozenset(['intron', 'CDS']),
+        'CDS': frozenset(['intron', 'UTR5']),
+        'intron': frozenset(['CDS', 'ncRNA', 'UTR3', 'UTR5']),
+        'UTR5': frozenset(['intron']),
+        'ncRNA': frozenset(['intron']),
+    }
+}
+
 
 def _first_two_columns(input_file):
     """Keep just first two columns of file."""
@@ -117,6 +138,16 @@ def _a_in_b(first, second):
     return first.start >= second.start and first.stop <= second.stop
 
 
+def _a_in_b_arr(first_starts, first_stops, second_starts, second_stops):
+    """
+    Check if intervals a are inside intervals b.
+
+    Arguments are numpy arrays of interval coordinates. They are broadcast
+    against each other, so many intervals can be compared at once.
+    """
+    return (first_starts >= second_starts) & (first_stops <= second_stops)
+
+
 def _get_biotype(interval):
     """
     Get interval biotype.
@@ -143,16 +174,11 @@ def _get_biotype(interval):
         Biotype of interval.
 
     """
-    if "transcript_biotype" in interval.attrs:
-        return interval.attrs['transcript_biotype']
-    elif "transcript_type" in interval.attrs:
-        return interval.attrs['transcript_type']
-    elif "gene_biotype" in interval.attrs:
-        return interval.attrs['gene_biotype']
-    elif "gene_type" in interval.attrs:
-        return interval.attrs['gene_type']
-    else:
-        return interval[1]
+    attrs = parse_attrs(interval[8])
+    for key in ('transcript_biotype', 'transcript_type', 'gene_biotype', 'gene_type'):
+        if key in attrs:
+            return attrs[key]
+    return interval[1]
 
 
 def _add_biotype_value(interval, biotype):
@@ -233,22 +259,6 @@ def _check_consistency(intervals):
         IN case any of the assert statements fails.
 
     """
-    can_follow = {
-        '+': {
-            'UTR5': ['intron', 'CDS'],
-            'CDS': ['intron', 'UTR3'],
-            'intron': ['CDS', 'ncRNA', 'UTR3', 'UTR5'],
-            'UTR3': ['intron'],
-            'ncRNA': ['intron'],
-        },
-        '-': {
-            'UTR3': ['intron', 'CDS'],
-            'CDS': ['intron', 'UTR5'],
-            'intron': ['CDS', 'ncRNA', 'UTR3', 'UTR5'],
-            'UTR5': ['intron'],
-            'ncRNA': ['intron'],
-        }
-    }
     intervals = intervals.copy()
     try:
         index = next(i for i in range(len(intervals)) if intervals[i][2] == 'transcript')
@@ -260,9 +270,13 @@ def _check_consistency(intervals):
     intervals = sorted(intervals, key=lambda x: x.start)
     assert transcript_interval.start == intervals[0].start
     assert transcript_interval.stop == intervals[-1].stop
-    for first, second in zip(intervals, intervals[1:]):
-        assert first.stop == second.start
-        assert second[2] in can_follow[strand][first[2]]
+
+    starts = numpy.array([interval.start for interval in intervals], dtype=numpy.int64)
+    stops = numpy.array([interval.stop for interval in intervals], dtype=numpy.int64)
+    assert numpy.array_equal(stops[:-1], starts[1:])
+
+    types = [interval[2] for interval in intervals]
+    assert all(second in _CAN_FOLLOW[strand][first] for first, second in zip(types, types[1:]))
 
 
 def _get_non_cds_exons(cdses, exons, intervals):
@@ -341,32 +355,47 @@ def _get_non_cds_exons(cdses, exons, intervals):
         cdses[index] = cds
     cdses.extend(new_cdses)
 
-    for exon in exons:
-        if not any(_a_in_b(cds, exon) for cds in cdses):
-            # no CDS in exon - completely UTR! Just determine UTR3/UTR5:
-            if ((exon.strand == '+' and exon.stop >= max([i.stop for i in cdses])) or
-                    (exon.strand == '-' and exon.start <= min([i.start for i in cdses]))):
-                mode = "UTR3"
-            else:
-                mode = "UTR5"
+    cds_starts = numpy.array([cds.start for cds in cdses])
+    cds_stops = numpy.array([cds.stop for cds in cdses])
+    cds_min_start = cds_starts.min()
+    cds_max_stop = cds_stops.max()
+
+    exon_starts = numpy.array([exon.start for exon in exons])
+    exon_stops = numpy.array([exon.stop for exon in exons])
+    exon_plus = numpy.array([exon.strand == '+' for exon in exons], dtype=bool)
+
+    # Check all CDS against all exons at once: inside[i, j] tells if CDS j is inside exon i.
+    inside = _a_in_b_arr(cds_starts, cds_stops, exon_starts[:, None], exon_stops[:, None])
+    has_cds = inside.any(axis=1)
+    first_cds = inside.argmax(axis=1)
+
+    # Exons without CDS are completely UTR, determine if they are UTR3 (or UTR5):
+    utr3_only = numpy.where(exon_plus, exon_stops >= cds_max_stop, exon_starts <= cds_min_start)
+    # Exons with CDS have UTR where CDS and exon borders differ:
+    utr_start = has_cds & (cds_starts[first_cds] != exon_starts)
+    utr_stop = has_cds & (cds_stops[first_cds] != exon_stops)
+
+    for exon, exon_has_cds, cds_index, is_utr3, has_utr_start, has_utr_stop in zip(
+            exons, has_cds.tolist(), first_cds.tolist(), utr3_only.tolist(), utr_start.tolist(), utr_stop.tolist()):
+        if not exon_has_cds:
+            # no CDS in exon - completely UTR!
+            mode = "UTR3" if is_utr3 else "UTR5"
             utrs.append(create_interval_from_list(
                 exon[:2] + [mode, exon.start + 1, exon.stop, '.', strand, '.', exon[8]]))
+            continue
 
-        else:
-            # CDS in exons! Identify which one:
-            cds = next((c for c in cdses if _a_in_b(c, exon)), None)
-            assert cds is not None
-
-            if cds.start != exon.start:
-                # UTR in the beggining:
-                mode = 'UTR5' if exon.strand == '+' else "UTR3"
-                utrs.append(create_interval_from_list(
-                    exon[:2] + [mode, exon.start + 1, cds.start, '.', strand, '.', exon[8]]))
-            if cds.stop != exon.stop:
-                # UTR in the end:
-                mode = "UTR3" if exon.strand == '+' else "UTR5"
-                utrs.append(create_interval_from_list(
-                    exon[:2] + [mode, cds.stop + 1, exon.stop, '.', strand, '.', exon[8]]))
+        # CDS in exon! Identify which one:
+        cds = cdses[cds_index]
+        if has_utr_start:
+            # UTR in the beggining:
+            mode = 'UTR5' if exon.strand == '+' else "UTR3"
+            utrs.append(create_interval_from_list(
+                exon[:2] + [mode, exon.start + 1, cds.start, '.', strand, '.', exon[8]]))
+        if has_utr_stop:
+            # UTR in the end:
+            mode = "UTR3" if exon.strand == '+' else "UTR5"
+            utrs.append(create_interval_from_list(
+                exon[:2] + [mode, cds.stop + 1, exon.stop, '.', strand, '.', exon[8]]))
 
     return cdses, utrs
 
@@ -375,7 +404,8 @@ def _filter_col8(interval, keys=None):
     """Filter the content of 9th column (attributes) in a GTF interval."""
     if keys is None:
         keys = ['gene_id', 'gene_name', 'transcript_id', 'transcript_name']
-    return ' '.join(['{} "{}";'.format(key, value) for key, value in sorted(interval.attrs.items()) if key in keys])
+    attrs = parse_attrs(interval[8])
+    return ' '.join(['{} "{}";'.format(key, value) for key, value in sorted(attrs.items()) if key in keys])
 
 
 def _get_introns(exons):
@@ -404,7 +434,9 @@ def _get_introns(exons):
     """
     # start of intron is on exon1.stop + 1
     # stop of intron is on exon2.start (since in GTF: e2.start = e2[3] - 1)
-    start_stop = [(e1.stop + 1, e2.start) for e1, e2 in zip(exons, exons[1:])]
+    exon_starts = numpy.array([exon.start for exon in exons], dtype=numpy.int64)
+    exon_stops = numpy.array([exon.stop for exon in exons], dtype=numpy.int64)
+    start_stop = zip((exon_stops[:-1] + 1).tolist(), exon_starts[1:].tolist())
 
     # For introns, keep only a subset of key-value pairs from column 8:
     col8 = _filter_col8(exons[0])
@@ -473,8 +505,12 @@ def _process_transcript_group(intervals):
     else:
         cdses = [i for i in intervals if i[2] == 'CDS']
         # check that all CDSs are within exons:
-        for cds in cdses:
-            assert any([_a_in_b(cds, exon) for exon in exons])
+        assert _a_in_b_arr(
+            numpy.array([cds.start for cds in cdses])[:, None],
+            numpy.array([cds.stop for cds in cdses])[:, None],
+            numpy.array([exon.start for exon in exons]),
+            numpy.array([exon.stop for exon in exons]),
+        ).any(axis=1).all()
 
         # Determine UTR intervals and new_cds (cds joined with stop codons where possible):
         new_cdses, utrs = _get_non_cds_exons(cdses, exons, intervals)
@@ -496,6 +532,36 @@ def _process_transcript_group(intervals):
     return container
 
 
+def _get_gaps(starts, stops, length):
+    """
+    Get gaps between intervals on chromosome of given length.
+
+    Intervals are given with lists of starts and stops in BED coordinates
+    and can be unsorted and overlapping. Gaps are returned as list of
+    (start, stop) tuples in BED coordinates, sorted by start.
+    """
+    if length == 0:
+        return []
+    if not starts:
+        return [(0, length)]
+
+    starts = numpy.array(starts, dtype=numpy.int64)
+    stops = numpy.array(stops, dtype=numpy.int64)
+    order = numpy.argsort(starts, kind='stable')
+    starts = starts[order]
+    # Furthest position covered by any of the intervals so far:
+    reach = numpy.maximum.accumulate(stops[order])
+
+    is_gap = starts[1:] > reach[:-1]
+    gaps = list(zip(reach[:-1][is_gap].tolist(), starts[1:][is_gap].tolist()))
+    if starts[0] > 0:
+        gaps.insert(0, (0, int(starts[0])))
+    if reach[-1] < length:
+        gaps.append((int(reach[-1]), length))
+    # Intervals may exceed chromosome end, so clip the gaps to chromosome length:
+    return [(start, min(stop, length)) for start, stop in gaps if start < length]
+
+
 def _complement(gtf, genome_file, strand, type_name='intergenic'):
     """
     Get the complement of intervals in gtf that have strand == `strand`.
@@ -514,6 +580,8 @@ def _complement(gtf, genome_file, strand, type_name='intergenic'):
         Path to genome_file (*.fai or similar).
     strand : string
         Strand for which to compute complement.
+    type_name : str
+        Name of the third column of complement segments.
 
     Returns
     -------
@@ -523,16 +591,33 @@ def _complement(gtf, genome_file, strand, type_name='intergenic'):
     """
     assert(strand in ['+', '-', '.'])
 
-    # Filter the content file by strand
-    gtf_strand_only = BedTool(gtf).filter(lambda x: x.strand == strand).saveas()
+    # Coordinates (in BED format) of intervals with given strand, grouped by chromosome:
+    coords = {}
+    for interval in BedTool(gtf):
+        if interval.strand == strand:
+            starts, stops = coords.setdefault(interval.chrom, ([], []))
+            starts.append(interval.start)
+            stops.append(interval.stop)
+
+    # Chromosomes are processed in the order they are given in genome_file:
+    chrom_lengths = []
+    with open(genome_file) as handle:
+        for line in handle:
+            if not line.strip():
+                continue
+            chrom, length = line.split()[:2]
+            chrom_lengths.append((chrom, int(length)))
 
-    # Sorted input is required for complement calculation:
-    gtf_sorted = gtf_strand_only.sort(faidx=genome_file).saveas()  # pylint: disable=unexpected-keyword-arg
+    unknown = set(coords) - {chrom for chrom, _ in chrom_lengths}
+    if unknown:
+        raise ValueError('Chromosomes {} are not defined in genome file.'.format(', '.join(sorted(unknown))))
 
-    # This step will fail if gtf_sorted has different set of chromosomes as they are defined in genome_file:
-    intergenic_bed = gtf_sorted.complement(g=genome_file).saveas()
+    intergenic_bed = []
+    for chrom, length in chrom_lengths:
+        starts, stops = coords.get(chrom, ([], []))
+        intergenic_bed.extend((chrom, start, stop) for start, stop in _get_gaps(starts, stops, length))
 
-    # intergenic_bed is BED3 file. We need to make it GTF. Note the differences in BED and  GTF:
+    # intergenic_bed holds BED coordinates. We need to make it GTF. Note the differences in BED and  GTF:
     # https://pythonhosted.org/pybedtools/intervals.html#bed-is-0-based-others-are-1-based
     # This effectively means:
     # gtf_start = bed_start + 1
@@ -544,8 +629,8 @@ def _complement(gtf, genome_file, strand, type_name='intergenic'):
     else:
         col8 = 'ID "interB%5.5d"; gene_id "."; transcript_id ".";'
     gtf = BedTool(
-        create_interval_from_list([i[0], '.', type_name, str(int(i[1]) + 1), i[2], '.', strand, '.', col8 % n])
-        for n, i in enumerate(intergenic_bed)
+        create_interval_from_list([chrom, '.', type_name, str(start + 1), str(stop), '.', strand, '.', col8 % n])
+        for n, (chrom, start, stop) in enumerate(intergenic_bed)
     ).saveas()
 
     return os.path.abspath(gtf.fn)
@@ -577,9 +662,12 @@ def _get_gene_content(gtf, chromosomes, report_progress=False):
         All intervals in gene, separated by transcript_id.
 
     """
-    # Lists to keep track of all already processed genes/transcripts:
-    gene_ids = []
-    transcript_ids = []
+    # Set of chromosomes makes membership check independent of the number of chromosomes:
+    chromosomes = frozenset(chromosomes)
+
+    # Sets to keep track of all already processed genes/transcripts:
+    gene_ids = set()
+    transcript_ids = set()
 
     current_transcript = None
     current_gene = None
@@ -596,7 +684,8 @@ def _get_gene_content(gtf, chromosomes, report_progress=False):
             gene_content['gene'] = create_interval_from_list(int1[:2] + ['gene', start + 1, stop] + int1[5:8] + [col8])
         return gene_content
 
-    length = BedTool(gtf).count()
+    # Counting intervals requires an extra pass through file, so only do it if needed:
+    length = BedTool(gtf).count() if report_progress else None
     progress, j = 0, 0
     for interval in BedTool(gtf):
         j += 1
@@ -615,7 +704,7 @@ def _get_gene_content(gtf, chromosomes, report_progress=False):
                     # New transcript - confirm that it is really a new one:
                     current_transcript = interval.attrs['transcript_id']
                     assert current_transcript not in transcript_ids
-                    transcript_ids.append(current_transcript)
+                    transcript_ids.add(current_transcript)
                     gene_content[current_transcript] = [interval]
 
             else:  # New gene!
@@ -626,7 +715,7 @@ def _get_gene_content(gtf, chromosomes, report_progress=False):
                 # Confirm that it is really new gene!
                 current_gene = interval.attrs['gene_id']
                 assert current_gene not in gene_ids
-                gene_ids.append(current_gene)
+                gene_ids.add(current_gene)
 
                 # Make empty container and classify interval
                 gene_content = {}
@@ -635,7 +724,7 @@ def _get_gene_content(gtf, chromosomes, report_progress=False):
                 elif 'transcript_id' in interval.attrs:
                     current_transcript = interval.attrs['transcript_id']
                     assert current_transcript not in transcript_ids
-                    transcript_ids.append(current_transcript)
+                    transcript_ids.add(current_transcript)
                     gene_content[current_transcript] = [interval]
                 else:
                     raise Exception("First element in gene content is neither gene or transcript!")
@@ -644,7 +733,52 @@ def _get_gene_content(gtf, chromosomes, report_progress=False):
     yield finalize(gene_content)
 
 
-def get_segments(annotation, segmentation, fai, report_progress=False):
+def _process_gene(gene_content):
+    """
+    Process each group of intervals belonging to gene.
+
+    Process each transcript_group in gene_content, add 'biotype'
+    attribute to all intervals and return them in a list that ends
+    with gene interval.
+    """
+    assert 'gene' in gene_content
+
+    for id_, transcript_group in gene_content.items():
+        if id_ == 'gene':
+            continue
+        gene_content[id_] = _process_transcript_group(transcript_group)
+
+    # Add biotype attribute to all intervals:
+    gene_content = _add_biotype_attribute(gene_content)
+
+    intervals = []
+    for id_, transcript_group in gene_content.items():
+        if id_ == 'gene':
+            continue
+        intervals.extend(transcript_group)
+    intervals.append(gene_content['gene'])
+    return intervals
+
+
+def _intervals_to_fields(content):
+    """Convert interval or list of intervals to (list of) fields, which can be passed between processes."""
+    if isinstance(content, list):
+        return [interval.fields for interval in content]
+    return content.fields
+
+
+def _process_gene_fields(gene_fields):
+    """Same as ``_process_gene``, but with intervals given and returned as lists of fields."""
+    gene_content = {}
+    for id_, fields in gene_fields.items():
+        if id_ == 'gene':
+            gene_content[id_] = create_interval_from_list(fields)
+        else:
+            gene_content[id_] = [create_interval_from_list(item) for item in fields]
+    return [interval.fields for interval in _process_gene(gene_content)]
+
+
+def get_segments(annotation, segmentation, fai, report_progress=False, threads=1):
     """
     Create GTF file with transcript level segmentation.
 
@@ -673,6 +807,8 @@ def get_segments(annotation, segmentation, fai, report_progress=False):
         Path to input genome_file (.fai or similar).
     report_progress : bool
         Show progress.
+    threads : int
+        Number of processes used for processing genes.
 
     Returns
     -------
@@ -684,7 +820,7 @@ def get_segments(annotation, segmentation, fai, report_progress=False):
     metrics = iCount.Metrics()
     metrics.genes = 0
 
-    # Container for storing intermediate data
+    # Container for storing fields of processed intervals
     data = []
 
     LOGGER.debug('Opening genome file: %s', fai)
@@ -692,37 +828,25 @@ def get_segments(annotation, segmentation, fai, report_progress=False):
     with open(fai) as gfile:
         chromosomes = [line.strip().split()[0] for line in gfile]
 
-    def process_gene(gene_content):
-        """
-        Process each group of intervals belonging to gene.
-
-        Process each transcript_group in gene_content, add 'biotype'
-        attribute to all intervals and include them in `data`.
-        """
-        assert 'gene' in gene_content
-
-        for id_, transcript_group in gene_content.items():
-            if id_ == 'gene':
-                continue
-            gene_content[id_] = _process_transcript_group(transcript_group)
-
-        # Add biotype attribute to all intervals:
-        gene_content = _add_biotype_attribute(gene_content)
-
-        for id_, transcript_group in gene_content.items():
-            if id_ == 'gene':
-                continue
-            data.extend(transcript_group)
-        data.append(gene_content['gene'])
-
     LOGGER.debug('Processing genome annotation from: %s', annotation)
-    for gene_content in _get_gene_content(annotation, chromosomes, report_progress):
-        process_gene(gene_content)
-        LOGGER.debug('Just processed gene: %s', gene_content['gene'].attrs['gene_id'])
-        metrics.genes += 1
+    gene_contents = _get_gene_content(annotation, chromosomes, report_progress)
+    if threads > 1:
+        with multiprocessing.Pool(threads) as pool:
+            serialized = ({id_: _intervals_to_fields(content) for id_, content in gene_content.items()}
+                          for gene_content in gene_contents)
+            for gene_data in pool.imap(_process_gene_fields, serialized, chunksize=64):
+                data.extend(gene_data)
+                # Gene interval is the last one in processed gene:
+                LOGGER.debug('Just processed gene: %s', parse_attrs(gene_data[-1][8]).get('gene_id'))
+                metrics.genes += 1
+    else:
+        for gene_content in gene_contents:
+            data.extend(interval.fields for interval in _process_gene(gene_content))
+            LOGGER.debug('Just processed gene: %s', gene_content['gene'].attrs['gene_id'])
+            metrics.genes += 1
 
     # Produce GTF/GFF file from data:
-    gtf = BedTool(i.fields for i in data).saveas()
+    gtf = BedTool(data).saveas()
 
     LOGGER.info('Calculating intergenic intervals...')
     intergenic_pos = _complement(gtf.fn, fai, '+')
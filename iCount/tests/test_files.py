@@ -42,6 +42,14 @@ class TestFilesTemp(unittest.TestCase):
             read_text = file_.read()
         self.assertEqual(read_text, test_text)
 
+    def test_compressed_fixture(self):
+        data = [['1', '15', '16', '.', '5', '+'], ['1', '20', '21', '.', '3', '-']]
+        fname = make_file_from_list(data, extension='bed.gz')
+        # File should be gzipped and have the same content when read back:
+        with open(fname, 'rb') as file_:
+            self.assertEqual(file_.read(2), b'\x1f\x8b')
+        self.assertEqual(make_list_from_file(fname, fields_separator='\t'), data)
+
     def tearDown(self):
         files = os.listdir(self.tempdir)
         for file_ in files:
@@ -0,0 +1,26 @@
+# pylint: disable=missing-docstring
+import unittest
+
+from iCount.genomes import gtf
+
+
+class TestParseAttrs(unittest.TestCase):
+
+    def test_basic(self):
+        col8 = 'gene_id "G1"; transcript_id "T1";exon_number 2; gene_name "ABC";'
+        expected = {'gene_id': 'G1', 'transcript_id': 'T1', 'exon_number': '2', 'gene_name': 'ABC'}
+        self.assertEqual(gtf.parse_attrs(col8), expected)
+
+    def test_empty(self):
+        self.assertEqual(gtf.parse_attrs('.'), {})
+        self.assertEqual(gtf.parse_attrs(''), {})
+
+    def test_interned(self):
+        # Values of selected keys are interned, so equal values are the same object:
+        first = gtf.parse_attrs('gene_id "{}";'.format(''.join(['G', '42'])))
+        second = gtf.parse_attrs('gene_id "{}";'.format(''.join(['G', '4', '2'])))
+        self.assertIs(first['gene_id'], second['gene_id'])
+
+
+if __name__ == '__main__':
+    unittest.main()
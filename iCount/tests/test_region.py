@@ -51,6 +51,14 @@ class TestConstructBorders(unittest.TestCase):
             sorted(results, key=lambda x: (x[0], x[-1], int(x[1]), int(x[2])))
         )
 
+        # BedTool that is not backed by a file gives the same result:
+        borders_file = region.construct_borders(BedTool(create_interval_from_list(seg) for seg in segmentation))
+        results = make_list_from_file(borders_file, fields_separator='\t')
+        self.assertEqual(
+            expected,
+            sorted(results, key=lambda x: (x[0], x[-1], int(x[1]), int(x[2])))
+        )
+
 
 class TestSimplifyBiotype(unittest.TestCase):
 
@@ -183,6 +191,30 @@ class TestMergeRegions(unittest.TestCase):
             )
 
 
+class TestGetGeneSizes(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+        self.tmp = get_temp_file_name()
+
+    def test_basic(self):
+        make_file_from_list([
+            ['1', '.', 'gene', '1', '10', '.', '+', '.', 'gene_id "G1";'],
+            ['1', '.', 'transcript', '1', '10', '.', '+', '.', 'gene_id "G1"; transcript_id "T1";'],
+            ['1', '.', 'gene', '21', '120', '.', '+', '.', 'gene_id "G2";'],
+        ], bedtool=False, tfile=self.tmp)
+        self.assertEqual(region.get_gene_sizes(self.tmp), {'.': 0, 'G1': 10, 'G2': 100})
+
+    def test_header_and_blank_lines(self):
+        make_file_from_list([
+            ['#!genome-build GRCh38.p13'],
+            ['track name=genes'],
+            ['1', '.', 'gene', '1', '10', '.', '+', '.', 'gene_id "G1";'],
+            [''],
+        ], bedtool=False, tfile=self.tmp)
+        self.assertEqual(region.get_gene_sizes(self.tmp), {'.': 0, 'G1': 10})
+
+
 class TestSummaryTemplates(unittest.TestCase):
 
     def setUp(self):
@@ -223,6 +255,18 @@ class TestSummaryTemplates(unittest.TestCase):
             ['G2', 'DEF', '20'],
         ])
 
+    def test_header_and_blank_lines(self):
+        out_dir = get_temp_dir()
+        annotation = make_file_from_list([
+            ['#!genome-build GRCh38.p13'],
+            ['1', '.', 'CDS', '11', '30', '.', '+', '.', 'biotype "mRNA";gene_name "A";gene_id "G1";'],
+            [''],
+        ], bedtool=False)
+        region.summary_templates(annotation, out_dir)
+
+        results_gene = make_list_from_file(os.path.join(out_dir, region.TEMPLATE_GENE), fields_separator='\t')
+        self.assertEqual(results_gene, [['G1', 'A', '20']])
+
 
 class TestMakeRegionsFile(unittest.TestCase):
 
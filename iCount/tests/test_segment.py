@@ -4,18 +4,18 @@ import warnings
 import unittest
 from unittest.mock import patch  # pylint: disable=unused-import
 
+import numpy
 from pybedtools import create_interval_from_list
 
 import iCount  # pylint: disable=unused-import
 from iCount.genomes import segment, region
 from iCount.tests.utils import list_to_intervals, intervals_to_list, reverse_strand, make_file_from_list, \
-    make_list_from_file, get_temp_file_name
+    make_files_from_lists, make_list_from_file, get_temp_file_name, get_temp_dir
 
+warnings.filterwarnings('ignore', category=ResourceWarning)
 
-class TestOtherFunctions(unittest.TestCase):
 
-    def setUp(self):
-        warnings.simplefilter("ignore", ResourceWarning)
+class TestOtherFunctions(unittest.TestCase):
 
     def test_a_in_b(self):
         second = create_interval_from_list(['1', '10', '20', 'Name', '42', '+'])
@@ -40,6 +40,35 @@ class TestOtherFunctions(unittest.TestCase):
         first = create_interval_from_list(['1', '25', '35', 'Name', '42', '+'])
         self.assertFalse(segment._a_in_b(first, second))
 
+    def test_a_in_b_arr(self):
+        # a completely in b, a == b, a out of b on left, a out of b on right, a completely out of b
+        first_starts = numpy.array([12, 10, 5, 15, 25])
+        first_stops = numpy.array([18, 20, 15, 25, 35])
+        numpy.testing.assert_array_equal(
+            segment._a_in_b_arr(first_starts, first_stops, 10, 20),
+            [True, True, False, False, False],
+        )
+
+        # Compare many intervals to many intervals:
+        second_starts = numpy.array([[10], [13]])
+        second_stops = numpy.array([[20], [20]])
+        numpy.testing.assert_array_equal(
+            segment._a_in_b_arr(first_starts[:2], first_stops[:2], second_starts, second_stops),
+            [[True, True], [False, False]],
+        )
+
+    def test_get_gaps(self):
+        self.assertEqual(segment._get_gaps([], [], 100), [(0, 100)])
+
+        # Unsorted, overlapping and touching intervals:
+        self.assertEqual(segment._get_gaps([50, 10, 20, 30], [60, 25, 30, 40], 100), [(0, 10), (40, 50), (60, 100)])
+
+        # Intervals covering chromosome ends or exceeding them:
+        self.assertEqual(segment._get_gaps([0, 50], [20, 120], 100), [(20, 50)])
+
+        # Chromosome of zero length has no gaps:
+        self.assertEqual(segment._get_gaps([], [], 0), [])
+
     def test_get_biotype(self):
         transcript_ensembl = create_interval_from_list(
             ['1', '.', 'gene', '1', '200', '.', '+', '.', 'transcript_biotype "T";'])
@@ -170,9 +199,6 @@ class TestOtherFunctions(unittest.TestCase):
 
 class TestGetNonCdsExons(unittest.TestCase):
 
-    def setUp(self):
-        warnings.simplefilter("ignore", ResourceWarning)
-
     def test_1(self):
         """
         Situation:
@@ -449,9 +475,6 @@ class TestGetNonCdsExons(unittest.TestCase):
 
 class TestProcessTranscriptGroup(unittest.TestCase):
 
-    def setUp(self):
-        warnings.simplefilter("ignore", ResourceWarning)
-
     def test_no_exons(self):
         """
         Fail if no exons are given.
@@ -483,6 +506,23 @@ class TestProcessTranscriptGroup(unittest.TestCase):
         output = intervals_to_list(segment._process_transcript_group(intervals))
         self.assertEqual(output, expected)
 
+    def test_unstranded_single_exon(self):
+        """
+        Unstranded transcript with single exon (as in StringTie output).
+        """
+        intervals = list_to_intervals([
+            ['1', '.', 'transcript', '1', '100', '.', '.', '.', ''],
+            ['1', '.', 'exon', '1', '100', '.', '.', '.', 'exon_number "1";'],
+        ])
+
+        expected = [
+            ['1', '.', 'transcript', '1', '100', '.', '.', '.', ''],
+            ['1', '.', 'ncRNA', '1', '100', '.', '.', '.', 'exon_number "1";'],
+        ]
+
+        output = intervals_to_list(segment._process_transcript_group(intervals))
+        self.assertEqual(output, expected)
+
     @unittest.mock.patch('builtins.print')
     def test_fail_validating(self, print_mock):
         """
@@ -503,16 +543,16 @@ class TestProcessTranscriptGroup(unittest.TestCase):
 
 class TestComplement(unittest.TestCase):
 
-    def setUp(self):
-        warnings.simplefilter("ignore", ResourceWarning)
-
     def test_complement(self):
 
+        # Blank lines and chromosomes of zero length should be skipped:
         genome_file = make_file_from_list(
             [
                 ['1', '2000'],
                 ['2', '1000'],
+                [''],
                 ['MT', '500'],
+                ['empty', '0'],
             ], bedtool=False)
 
         genes = list_to_intervals([
@@ -523,7 +563,7 @@ class TestComplement(unittest.TestCase):
             ['2', '.', 'gene5', '100', '300', '.', '-', '.', '.'],
         ])
 
-        complement = make_list_from_file(segment._complement(genes, genome_file, '+'), fields_separator='\t')
+        complement = segment._complement(genes, genome_file, '+')
 
         empty_col8 = 'ID "inter%s"; gene_id "."; transcript_id ".";'
         expected = [
@@ -533,15 +573,15 @@ class TestComplement(unittest.TestCase):
             ['2', '.', 'intergenic', '201', '1000', '.', '+', '.', empty_col8 % "P00003"],
             ['MT', '.', 'intergenic', '1', '500', '.', '+', '.', empty_col8 % "P00004"],
         ]
+        expected_file = make_file_from_list(expected, bedtool=False)
 
-        self.assertEqual(complement, expected)
+        # Compare files byte for byte, but show the differing lines on failure:
+        with open(complement) as result_handle, open(expected_file) as expected_handle:
+            self.assertEqual(result_handle.read(), expected_handle.read())
 
 
 class TestGetGeneContent(unittest.TestCase):
 
-    def setUp(self):
-        warnings.simplefilter("ignore", ResourceWarning)
-
     def test_all_good(self):
         """
         * second gene has no 'gene' interval - but it is present in output as it should
@@ -624,9 +664,6 @@ class TestGetGeneContent(unittest.TestCase):
 
 class TestGetSegment(unittest.TestCase):
 
-    def setUp(self):
-        warnings.simplefilter("ignore", ResourceWarning)
-
     def test_all_good(self):
         gtf_in_data = list_to_intervals([
             ['1', '.', 'gene', '400', '500', '.', '+', '.', 'gene_id "G2";'],
@@ -636,15 +673,13 @@ class TestGetSegment(unittest.TestCase):
             ['1', '.', 'exon', '470', '500', '.', '+', '.', 'gene_id "G2"; transcript_id "T3"; exon_number "2"'],
             ['1', '.', 'CDS', '470', '490', '.', '+', '.', 'gene_id "G2"; transcript_id "T3";'],
         ])
-        gtf_in_file = make_file_from_list(intervals_to_list(gtf_in_data))
+        gtf_in_file, genome_file = make_files_from_lists([
+            {'data': intervals_to_list(gtf_in_data)},
+            {'data': [['1', '2000'], ['MT', '500']], 'bedtool': False},
+        ])
 
         gtf_out = get_temp_file_name()
 
-        genome_file = make_file_from_list([
-            ['1', '2000'],
-            ['MT', '500'],
-        ], bedtool=False)
-
         segment.get_segments(gtf_in_file, gtf_out, genome_file)
         gtf_out_data = list_to_intervals(make_list_from_file(gtf_out, fields_separator='\t'))
 
@@ -671,6 +706,49 @@ class TestGetSegment(unittest.TestCase):
         self.assertTrue(os.path.isfile(os.path.join(out_dir, region.REGIONS_FILE)))
         self.assertTrue(os.path.isfile(os.path.join(out_dir, 'landmarks.bed.gz')))
 
+    def test_threads(self):
+        gtf_in_file, genome_file = make_files_from_lists([
+            {'data': [
+                ['1', '.', 'gene', '400', '500', '.', '+', '.', 'gene_id "G1";'],
+                ['1', '.', 'transcript', '400', '500', '.', '+', '.', 'gene_id "G1"; transcript_id "T1";'],
+                ['1', '.', 'exon', '400', '430', '.', '+', '.', 'gene_id "G1"; transcript_id "T1"; exon_number "1"'],
+                ['1', '.', 'CDS', '410', '430', '.', '+', '.', 'gene_id "G1"; transcript_id "T1";'],
+                ['1', '.', 'exon', '470', '500', '.', '+', '.', 'gene_id "G1"; transcript_id "T1"; exon_number "2"'],
+                ['1', '.', 'CDS', '470', '490', '.', '+', '.', 'gene_id "G1"; transcript_id "T1";'],
+                ['1', '.', 'gene', '600', '700', '.', '-', '.', 'gene_id "G2";'],
+                ['1', '.', 'transcript', '600', '700', '.', '-', '.', 'gene_id "G2"; transcript_id "T2";'],
+                ['1', '.', 'exon', '600', '700', '.', '-', '.', 'gene_id "G2"; transcript_id "T2"; exon_number "1"'],
+                ['MT', '.', 'gene', '100', '200', '.', '+', '.', 'gene_id "G3";'],
+                ['MT', '.', 'transcript', '100', '200', '.', '+', '.', 'gene_id "G3"; transcript_id "T3";'],
+                ['MT', '.', 'exon', '100', '200', '.', '+', '.', 'gene_id "G3"; transcript_id "T3"; exon_number "1"'],
+            ]},
+            {'data': [['1', '2000'], ['MT', '500']], 'bedtool': False},
+        ])
+
+        # Output should be the same regardless of the number of processes used:
+        results = []
+        for threads in [1, 2]:
+            gtf_out = os.path.join(get_temp_dir(), 'segmentation.gtf')
+            segment.get_segments(gtf_in_file, gtf_out, genome_file, threads=threads)
+            results.append(make_list_from_file(gtf_out, fields_separator='\t'))
+        self.assertEqual(results[0], results[1])
+
+    def test_process_gene_fields(self):
+        gtf_in_file = make_file_from_list([
+            ['1', '.', 'gene', '400', '500', '.', '+', '.', 'gene_id "G2";'],
+            ['1', '.', 'transcript', '400', '500', '.', '+', '.', 'gene_id "G2"; transcript_id "T3";'],
+            ['1', '.', 'exon', '400', '430', '.', '+', '.', 'gene_id "G2"; transcript_id "T3"; exon_number "1"'],
+            ['1', '.', 'CDS', '410', '430', '.', '+', '.', 'gene_id "G2"; transcript_id "T3";'],
+            ['1', '.', 'exon', '470', '500', '.', '+', '.', 'gene_id "G2"; transcript_id "T3"; exon_number "2"'],
+            ['1', '.', 'CDS', '470', '490', '.', '+', '.', 'gene_id "G2"; transcript_id "T3";'],
+        ])
+
+        # Processing intervals passed as fields (as done in worker processes) gives the same result:
+        gene_content = next(segment._get_gene_content(gtf_in_file, ['1']))
+        gene_fields = {id_: segment._intervals_to_fields(content) for id_, content in gene_content.items()}
+        expected = [interval.fields for interval in segment._process_gene(gene_content)]
+        self.assertEqual(segment._process_gene_fields(gene_fields), expected)
+
 
 if __name__ == '__main__':
     unittest.main()
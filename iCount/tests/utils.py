@@ -1,8 +1,14 @@
 """Utility functions for testing."""
 # pylint: disable=protected-access
+import atexit
+import concurrent.futures
+import gzip
+import itertools
 import os
+import shutil
 import tempfile
 
+import numpy
 import pysam
 from numpy import random
 
@@ -13,12 +19,27 @@ import iCount
 
 BASES = ['A', 'C', 'G', 'T']
 
+# Directory for temporary files of this test session, removed on exit:
+TMP_DIR = tempfile.mkdtemp(prefix='icount_tests_')
+atexit.register(shutil.rmtree, TMP_DIR, ignore_errors=True)
+_TMP_COUNTER = itertools.count()
+
+# Files made by make_file_from_list, keyed by their content and options:
+_FIXTURE_FILES = {}
+
+# Executor shared by all calls of make_files_from_lists (threads are started lazily):
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+atexit.register(_EXECUTOR.shutdown)
+
 
 def get_temp_file_name(tmp_dir=None, extension=''):
     """Return an availiable name for temporary file."""
-    tmp_name = next(tempfile._get_candidate_names())
-    if not tmp_dir:
-        tmp_dir = tempfile._get_default_tempdir()
+    if tmp_dir:
+        tmp_name = next(tempfile._get_candidate_names())
+    else:
+        # Session directory is private, so process id and counter are enough for unique name:
+        tmp_name = '{}_{}'.format(os.getpid(), next(_TMP_COUNTER))
+        tmp_dir = TMP_DIR
     if extension:
         tmp_name += '.' + extension
     return os.path.join(tmp_dir, tmp_name)
@@ -30,35 +51,66 @@ def get_temp_dir(tmp_dir=None):
 
 
 def make_file_from_list(data, bedtool=True, extension='', tmp_dir=None, tfile=None, sort=False):
-    """Return path to file with the content from `data` (list of lists)."""
+    """
+    Return path to file with the content from `data` (list of lists).
+
+    Files are reused if they were already made from the same content with
+    the same options, unless `tfile` is given.
+    """
+    cache_key = None
     if tfile is None:
+        cache_key = repr((data, bedtool, extension, tmp_dir, sort))
+        if cache_key in _FIXTURE_FILES and os.path.isfile(_FIXTURE_FILES[cache_key]):
+            return _FIXTURE_FILES[cache_key]
         tfile = get_temp_file_name(extension=extension, tmp_dir=tmp_dir)
     if bedtool:
-        tmp_bt = pybedtools.BedTool(
-            pybedtools.create_interval_from_list(line) for line in data).saveas()
+        # Rows are parsed as intervals, but written directly, the same way BedTool.saveas would:
+        intervals = [pybedtools.create_interval_from_list(line) for line in data]
         if sort:
-            tmp_bt.sort().saveas(tfile)
-        else:
-            tmp_bt.saveas(tfile)
+            # Sort by chromosome and start, same as ``bedtools sort`` does:
+            intervals.sort(key=lambda interval: (interval.chrom, interval.start))
+        content = ''.join(str(interval) for interval in intervals)
     else:
-        with open(tfile, 'wt') as file_:
-            for list_ in data:
-                file_.write('\t'.join(map(str, list_)) + '\n')
-    return os.path.abspath(tfile)
+        content = ''.join('\t'.join(map(str, list_)) + '\n' for list_ in data)
+    # BedTool.saveas compresses files ending with .gz, so do the same for bedtool files:
+    open_ = gzip.open if bedtool and tfile.endswith('.gz') else open
+    with open_(tfile, 'wb') as file_:
+        file_.write(content.encode())
+
+    tfile = os.path.abspath(tfile)
+    if cache_key is not None:
+        _FIXTURE_FILES[cache_key] = tfile
+    return tfile
+
+
+def make_files_from_lists(fixtures):
+    """
+    Return paths to files made from each element in `fixtures`, writing them concurrently.
+
+    Each element of `fixtures` is a dict of keyword arguments for
+    ``make_file_from_list``.
+    """
+    return list(_EXECUTOR.map(lambda kwargs: make_file_from_list(**kwargs), fixtures))
 
 
 def make_list_from_file(fname, fields_separator=None):
     """Read file to list of lists."""
-    data = []
     with iCount.files.gz_open(fname, 'rt') as file_:
-        for line in file_:
-            data.append(line.strip().split(fields_separator))
-    return data
+        return [line.strip().split(fields_separator) for line in file_]
 
 
 def list_to_intervals(data):
-    """Transform list of lists to list of pybedtools.Intervals."""
-    return [create_interval_from_list(list_) for list_ in data]
+    """
+    Transform list of lists to list of pybedtools.Intervals.
+
+    Identical rows within ``data`` share the same Interval object.
+    """
+    intervals = {}
+    for list_ in data:
+        key = tuple(list_)
+        if key not in intervals:
+            intervals[key] = create_interval_from_list(list_)
+    return [intervals[tuple(list_)] for list_ in data]
 
 
 def intervals_to_list(data):
@@ -73,13 +125,16 @@ def reverse_strand(data):
     Elements can be pybedtools.Intervals or lists with same content as
     interval.fields.
     """
-    rstrands = ['-' if i[6] == '+' else '+' for i in data]
-    if isinstance(data[0], pybedtools.Interval):
-        return [create_interval_from_list(
-            data[i][:6] + [rstrands[i]] + data[i][7:]) for i in range(len(data))]
+    strands = [i[6] for i in data]
+    if strands.count(strands[0]) == len(strands):
+        # Usually all intervals are on the same strand, so there is just one value to flip:
+        rstrands = ['-' if strands[0] == '+' else '+'] * len(strands)
     else:
-        return [
-            data[i][:6] + [rstrands[i]] + data[i][7:] for i in range(len(data))]
+        rstrands = numpy.where(numpy.array(strands) == '+', '-', '+').tolist()
+    rows = [list_[:6] + [rstrand] + list_[7:] for list_, rstrand in zip(data, rstrands)]
+    if isinstance(data[0], pybedtools.Interval):
+        return [create_interval_from_list(row) for row in rows]
+    return rows
 
 
 def make_sequence(size, include_n=False, rnd_seed=42):